@@ -2,8 +2,9 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-from numpy.fft import fft
-from scipy.linalg import norm, solve
+# solve allows broadcasting when imported from numpy
+from numpy.linalg import cond, eig, solve
+from scipy.fft import rfft
 
 # from .helper.modal_plotting import plot_frf, plot_stab
 from .lti_conversion import discrete2cont
@@ -70,8 +71,8 @@ class FNSI(NLSS, NonlinearStateSpace, StateSpaceIdent):
 
     def to_cont(self, method='zoh', alpha=None):
         """Convert to discrete time. Only A and B changes for zoh method"""
-        Bext = np.hstack((self.B, -self.E))
-        Dext = np.hstack((self.D, -self.Ff))
+        Bext = _ext_matrix(self.B, self.E)
+        Dext = _ext_matrix(self.D, self.Ff)
         Ac, Bcext, Cc, Dcext = \
             discrete2cont(self.A, Bext, self.C, Dext, self.dt, method, alpha)
 
@@ -109,30 +110,31 @@ class FNSI(NLSS, NonlinearStateSpace, StateSpaceIdent):
         # if the data is not truly periodic, there is a slight difference
         # between doing Y=fft(sig.y); Ymean = np.sum(Y) / sig.P and taking the
         # fft directly of the averaged time signal as here.
-        Umean = fft(sig.um, axis=0)
-        Ymean = fft(sig.ym, axis=0)
+        # The extended input e = [u, -g] and y are stacked in one (npp, m+nnl+p)
+        # array, so they can be transformed in one call.
+        m, p, nnl = self.m, self.p, self.nlx.n_nl
+        nu = m + nnl
+        EY = np.empty((npp, nu+p))
+        EY[:, :m] = sig.um
+        EY[:, nu:] = sig.ym
 
         # In case of no nonlinearities
-        if self.nlx.n_nl == 0:
+        if nnl == 0:
             scaling = []
-            E = Umean
         else:
-            # only output-based NLs
-            fnl = self.nlx.fnl(0, sig.ym, 0).T
-            nnl = fnl.shape[1]
-
-            scaling = np.zeros(nnl)
-            for j in range(nnl):
-                scaling[j] = np.std(sig.u[:, 0]) / np.std(fnl[:, j])
-                fnl[:, j] *= scaling[j]
-
-            FNL = fft(fnl, axis=0)
-            # concatenate to form extended input spectra matrix
-            E = np.hstack((Umean, -FNL))
-
-        U = E[self.lines]/np.sqrt(npp)
-        Y = Ymean[self.lines]/np.sqrt(npp)
-        scaling = scaling
+            # only output-based NLs. fnl is (nnl, npp); write it transposed
+            # and scaled directly into the stacked array
+            fnl = self.nlx.fnl(0, sig.ym, 0)
+            # scale each nl to the std of the input
+            scaling = np.std(sig.u[:, 0]) / np.std(fnl, axis=1)
+            np.multiply(fnl.T, -scaling, out=EY[:, m:nu])
+
+        # All signals are real and only lines up to nyquist are used.
+        EY = rfft(EY, axis=0, workers=-1)
+        # select the lines before scaling, to avoid a full-length temporary
+        EY = EY[self.lines] * (1/np.sqrt(npp))
+        U = EY[:, :nu]
+        Y = EY[:, nu:]
         return U, Y, scaling
 
     def estimate(self, n, r, bd_method='opt', fmin=None, fmax=None, weight=None):
@@ -191,17 +193,20 @@ class FNSI(NLSS, NonlinearStateSpace, StateSpaceIdent):
         p, m, nnl = self.p, self.m, self.nlx.n_nl
         Ac, Bc, Cc, Dc, Ec, Fc = self.to_cont(method='zoh')
         # Recombine E and F. They were extracted as negative part of B and D
-        Bext = np.hstack((Bc, -Ec))
-        Dext = np.hstack((Dc, -Fc))
-
-        freq = np.arange(sig.npp)/sig.npp/self.dt
-        F = len(lines)
-
+        Bext = _ext_matrix(Bc, Ec)
+        Dext = _ext_matrix(Dc, Fc)
+        # validate once; the batched solves below do not check their input
+        if not (np.isfinite(Ac).all() and np.isfinite(Bext).all()):
+            raise ValueError('Continuous-time model contains infs or NaNs')
+
+        # eq. 47. Laplace variable s = 2πjf, only evaluated at the used lines
+        s = 2j*np.pi/(self.dt*sig.npp) * lines
         # just return in case of no nonlinearities
         if nnl == 0:
+            G = _ext_frf(Ac, Bc, Cc, Dc, s)[:, :, 0]
             knl = np.empty(shape=(0, 0))
-        else:
-            knl = np.empty((F, nnl), dtype=complex)
+            self.knl = knl
+            return G, knl
 
         # Determine which dofs are connected.
         inl1 = np.zeros(nnl, dtype=int)
@@ -217,20 +222,11 @@ class FNSI(NLSS, NonlinearStateSpace, StateSpaceIdent):
             else:
                 inl2[i] = idx[1,1]
 
-        # Extra +1 zeros for p in He is for ground connections
-        G = np.empty((F, p), dtype=complex)
-        He = np.empty((F, p+1, m+nnl), dtype=complex)
-        He[:, -1, :] = 0
-
-        In = np.eye(*Ac.shape, dtype=complex)
-        for k in range(F):
-            # eq. 47
-            He[k, :-1, :] = Cc @ solve(In*2j*np.pi *
-                                       freq[lines[k]] - Ac, Bext) + Dext
-
-        for i in range(nnl):
-            knl[:, i] = -He[:, iu, m+i] / (He[:, inl1[i], 0]-He[:, inl2[i], 0])
-
+        He = _ext_frf(Ac, Bext, Cc, Dext, s)
+        # ground connections (inl2 = -1) have zero response
+        He2 = He[:, inl2, 0]
+        He2[:, inl2 == -1] = 0
+        knl = -He[:, iu, m:] / (He[:, inl1, 0] - He2)
         G = He[:, :p, 0]
 
         self.knl = knl
@@ -249,3 +245,45 @@ class FNSI(NLSS, NonlinearStateSpace, StateSpaceIdent):
             #print('exp: {:s}\t ℝ(mu) {:.4e}\t 𝕀(mu)  {:.4e}'.
             #      format(exponent, *mu_mean))
             print(f' Ratio log₁₀(ℝ(mu)/𝕀(mu))= {ratio:0.2f}')
+
+
+def _ext_matrix(X, Y):
+    """Return [X, -Y], negating Y directly into the output array"""
+    # Y might be empty, ie. np.array([]), if there are no nonlinearities
+    Y = Y.reshape(X.shape[0], -1)
+    Z = np.empty((X.shape[0], X.shape[1] + Y.shape[1]),
+                 dtype=np.result_type(X, Y))
+    Z[:, :X.shape[1]] = X
+    np.negative(Y, out=Z[:, X.shape[1]:])
+    return Z
+
+
+def _ext_frf(Ac, Bext, Cc, Dext, s):
+    """Extended FRF He(s) = Cc (sI - Ac)⁻¹ Bext + Dext, eq. (47)
+
+    Returns
+    -------
+    He : complex ndarray(F, p, m+nnl)
+    """
+    F = len(s)
+    p, n = Cc.shape
+    # With Ac = V Λ V⁻¹, (sI - Ac)⁻¹ = V (sI - Λ)⁻¹ V⁻¹, so each frequency
+    # line is only a scaling of the columns of C V. The product with V⁻¹B is
+    # done for all lines as one (F*p, n) x (n, m+nnl) matrix product.
+    lam, V = eig(Ac)
+    if cond(V) < 1e8:
+        CV = Cc @ V
+        VinvB = solve(V, Bext)
+        CVs = CV * (1/(s[:, None] - lam))[:, None, :]
+        return (CVs.reshape(F*p, n) @ VinvB).reshape(F, p, -1) + Dext
+
+    # Ac is (close to) defective. Solve all lines in one batched call.
+    # Only the diagonal of sI - Ac depends on the frequency
+    M = np.empty((F, n, n), dtype=complex)
+    M[:] = -Ac
+    # strided view of the diagonals, avoids fancy indexing
+    M.reshape(F, n*n)[:, ::n+1] += s[:, None]
+    X = solve(M, np.broadcast_to(Bext, (F,) + Bext.shape))
+    # one (p, n) x (n, F*(m+nnl)) product instead of F small ones
+    X = X.transpose(1, 0, 2).reshape(n, -1)
+    return (Cc @ X).reshape(p, F, -1).transpose(1, 0, 2) + Dext